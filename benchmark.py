@@ -0,0 +1,328 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Benchmarks the LOC pipeline of today.py (loc_query + cache_builder) against a local stand-in for GitHub's GraphQL API,
+# so it can be timed without a token and without touching api.github.com.
+# e.g. python benchmark.py --repos 200 --commits 2000 --latency 0.05 --error-rate 0.02
+OWNER_ID = 'U_benchmark'
+HISTORY_FILE = 'benchmark_history.jsonl'
+NOISE_FLOOR = 0.05 # Slowdowns smaller than this many seconds are never reported, warm runs are too short to time reliably
+
+
+def synthetic_user(login, repos, commits, own_share, seed):
+    """
+    Returns a fake account: a dictionary of 'owner/name' -> repository, each with stars and a newest-first commit list
+    A third of the repositories belong to an organization, so stars and affiliations can be told apart
+    """
+    rng = random.Random(seed)
+    repositories = {}
+    for index in range(repos):
+        owner = login if index % 3 else 'org' + str(index % 7)
+        history = []
+        for number in range(rng.randint(0, commits)):
+            history.append({'oid': hashlib.sha1(f'{owner}/{index}/{number}'.encode('utf-8')).hexdigest(),
+                            'author': OWNER_ID if rng.random() < own_share else 'U_someone_else',
+                            'additions': rng.randint(0, 400), 'deletions': rng.randint(0, 150),
+                            'committedDate': '2024-01-01T00:00:00Z'})
+        repositories[f'{owner}/repo{index}'] = {'stars': rng.randint(0, 50), 'history': history}
+    return {'login': login, 'followers': rng.randint(0, 500), 'repositories': repositories}
+
+
+def add_commits(user, count, seed):
+    """
+    Pushes count new commits by the owner to random repositories, so the incremental run has something to refresh
+    """
+    rng = random.Random(seed)
+    for number in range(count):
+        name = rng.choice(list(user['repositories']))
+        user['repositories'][name]['history'].insert(0, {'oid': hashlib.sha1(f'new/{seed}/{number}'.encode('utf-8')).hexdigest(),
+            'author': OWNER_ID, 'additions': rng.randint(0, 400), 'deletions': rng.randint(0, 150), 'committedDate': '2025-01-01T00:00:00Z'})
+
+
+def expected_loc(user):
+    """
+    Returns the (added, deleted, commits) totals today.py should arrive at for user
+    """
+    commits = [commit for repository in user['repositories'].values() for commit in repository['history'] if commit['author'] == OWNER_ID]
+    return sum(commit['additions'] for commit in commits), sum(commit['deletions'] for commit in commits), len(commits)
+
+
+class FakeGitHub(BaseHTTPRequestHandler):
+    """
+    Answers the handful of GraphQL documents today.py sends, from the synthetic user in server.user
+    Queries are recognised by their shape rather than parsed, so this has to be kept in step with the queries in today.py
+    Also answers the REST commit endpoint used by commit_languages
+    """
+    extensions = ['.py', '.js', '.html', '.md', '.c'] # the changed files of a commit get these extensions, picked by its oid
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+        match = re.fullmatch(r'/repos/([^/]+/[^/]+)/commits/([0-9a-f]+)', self.path)
+        repository = server.user['repositories'].get(match.group(1)) if match else None
+        commit = next((commit for commit in repository['history'] if commit['oid'] == match.group(2)), None) if repository else None
+        if commit is None:
+            return self.reply(404, {'message': 'Not Found'})
+        count = 1 + int(commit['oid'][0], 16) % 3 # split the commit's additions and deletions over 1 to 3 files
+        files = []
+        for number in range(count): # the last file also gets the remainder, so the files add up to the commit
+            extension = self.extensions[(int(commit['oid'][1:3], 16) + number) % len(self.extensions)]
+            additions, deletions = commit['additions'] // count, commit['deletions'] // count
+            if number == count - 1:
+                additions, deletions = commit['additions'] - additions * (count - 1), commit['deletions'] - deletions * (count - 1)
+            files.append({'filename': f'src/file{number}{extension}', 'additions': additions, 'deletions': deletions})
+        self.reply(200, {'sha': commit['oid'], 'files': files})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+        if server.rng.random() < server.error_rate: # alternate between a server error and a secondary rate limit
+            if server.rng.random() < 0.5:
+                return self.reply(502, {'message': 'Server Error'})
+            return self.reply(403, {'message': 'You have exceeded a secondary rate limit.'}, {'Retry-After': '0'})
+        try:
+            data = self.resolve(body['query'], body.get('variables') or {})
+        except (KeyError, ValueError) as error:
+            return self.reply(200, {'errors': [{'message': 'benchmark server cannot answer this query: ' + repr(error)}]})
+        if 'rateLimit' in body['query']: # roughly GitHub's rule: one point per 100 nodes requested, and at least one
+            cost = max(1, len(re.findall(r'\br\d+: repository\(', body['query'])))
+            with server.lock:
+                server.remaining = max(0, server.remaining - cost)
+                data['rateLimit'] = {'cost': cost, 'remaining': server.remaining, 'resetAt': server.reset_at}
+        self.reply(200, {'data': data})
+
+    def reply(self, status, payload, headers=None):
+        out = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def resolve(self, query, variables):
+        user = self.server.user
+        if 'HistoryPage' in query: # history_page: one aliased repository per r0, r1, ...
+            data = {}
+            author = variables['author']['id'] if 'author: $author' in query else None
+            for index in re.findall(r'\br(\d+): repository\(', query):
+                name = variables['owner' + index] + '/' + variables['repo_name' + index]
+                data['r' + index] = self.repository(name, variables.get('cursor' + index), author)
+            return data
+        if '$owner_affiliation' in query: # loc_query
+            names = [name for name in user['repositories'] if self.affiliated(name, variables['owner_affiliation'])]
+            first = int(re.search(r'repositories\(first: (\d+)', query).group(1))
+            start = int(variables.get('cursor') or 0)
+            return {'user': {'repositories': {'totalCount': len(names), 'edges': [{'node': self.listing(name)} for name in names[start:start + first]],
+                    'pageInfo': {'endCursor': str(start + first), 'hasNextPage': start + first < len(names)}}}}
+        if 'Fingerprint' in query: # fingerprint_query: dictionaries keep insertion order, which stands in for push order
+            owned = [repository['stars'] for name, repository in sorted(user['repositories'].items()) if self.affiliated(name, ['OWNER'])]
+            start = int(variables.get('cursor') or 0)
+            data = {'owned': {'totalCount': len(owned), 'nodes': [{'stargazerCount': stars} for stars in owned[start:start + 100]],
+                    'pageInfo': {'endCursor': str(start + 100), 'hasNextPage': start + 100 < len(owned)}}}
+            if variables['first_page']:
+                names = list(user['repositories'])
+                data.update({'followers': {'totalCount': user['followers']},
+                             'repositories': {'totalCount': len(names), 'nodes': [self.head(name) for name in names[:100]]}})
+            return {'user': data}
+        if 'createdAt' in query: # profile_getter
+            owned = sum(1 for name in user['repositories'] if self.affiliated(name, ['OWNER']))
+            return {'user': {'id': OWNER_ID, 'createdAt': '2019-11-03T21:15:07Z', 'followers': {'totalCount': user['followers']},
+                    'repositories': {'totalCount': owned}}}
+        raise ValueError(query)
+
+    def affiliated(self, name, affiliations):
+        return len(affiliations) > 1 or name.split('/')[0] == self.server.user['login']
+
+    def listing(self, name):
+        repository = self.server.user['repositories'][name]
+        branch = {'target': {'history': {'totalCount': len(repository['history'])}}} if repository['history'] else None
+        return {'nameWithOwner': name, 'owner': {'login': name.split('/')[0]}, 'stargazers': {'totalCount': repository['stars']}, 'defaultBranchRef': branch}
+
+    def head(self, name):
+        history = self.server.user['repositories'][name]['history']
+        branch = {'target': {'oid': history[0]['oid'], 'history': {'totalCount': len(history)}}} if history else None
+        return {'nameWithOwner': name, 'defaultBranchRef': branch}
+
+    def repository(self, name, cursor, author=None):
+        repository = self.server.user['repositories'].get(name)
+        if repository is None:
+            return None
+        if not repository['history']:
+            return {'defaultBranchRef': None}
+        history = [commit for commit in repository['history'] if author in (None, commit['author'])]
+        start = int(cursor or 0)
+        page = history[start:start + 100]
+        edges = [{'node': {'committedDate': commit['committedDate'], 'oid': commit['oid'], 'author': {'user': {'id': commit['author']}},
+                  'additions': commit['additions'], 'deletions': commit['deletions']}} for commit in page]
+        return {'defaultBranchRef': {'target': {'history': {'totalCount': len(history), 'edges': edges,
+                'pageInfo': {'endCursor': str(start + len(page)), 'hasNextPage': start + len(page) < len(history)}}}}}
+
+
+def start_server(user, latency, error_rate, seed, rate_limit=5000):
+    """
+    Starts the stand-in GraphQL server on a free local port in a background thread, and returns it
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGitHub)
+    server.daemon_threads = True
+    server.user, server.latency, server.error_rate = user, latency, error_rate
+    server.rng, server.lock, server.requests = random.Random(seed), threading.Lock(), 0
+    server.remaining, server.reset_at = rate_limit, (datetime.datetime.utcnow() + datetime.timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed_run(today, server):
+    """
+    Runs loc_query + cache_builder once, the same way the main block of today.py does, and stats_builder if LANGUAGE_STATS is on
+    Returns the wall time, the LOC totals (and the language stats totals), the number of queries per function, and the bytes received
+    """
+    for funct_id in today.QUERY_COUNT:
+        today.QUERY_COUNT[funct_id], today.QUERY_TIME[funct_id] = 0, 0.0
+    server.requests, today.RATE_LIMIT['deferred'] = 0, 0
+    first_span = len(today.SPANS)
+    start = time.perf_counter()
+    listing = today.loc_query(['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'])
+    total_loc = today.cache_builder(listing['edges'], 7, False)
+    commits = today.commit_counter(7)
+    languages = None
+    if today.LANGUAGE_STATS:
+        totals = today.stats_totals(today.stats_builder(listing['edges'], 7), 'language').values()
+        languages = [sum(total[0] for total in totals), sum(total[1] for total in totals)]
+    return {'seconds': round(time.perf_counter() - start, 4), 'loc': [total_loc[0], total_loc[1], commits], 'languages': languages,
+            'queries': dict(today.QUERY_COUNT), 'http_requests': server.requests, 'deferred': today.RATE_LIMIT['deferred'],
+            'bytes': sum(span['args']['bytes'] for span in today.SPANS[first_span:] if span['cat'] in ('graphql', 'rest'))}
+
+
+def git_revision():
+    """
+    Returns the commit the benchmark was run on (with a + if the tree has local changes), or None outside a git checkout
+    """
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('+' if dirty else '')
+
+
+def compare(result, history_file, threshold):
+    """
+    Compares result with the last recorded run of the same scenario in history_file
+    Returns a list of regressions: any phase that got more than threshold (and NOISE_FLOOR) slower, or that sent more queries
+    """
+    previous = None
+    if os.path.exists(history_file):
+        with open(history_file, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['scenario'] == result['scenario']:
+                    previous = record
+    if previous is None:
+        return []
+    regressions = []
+    for phase in ('cold', 'warm', 'incremental'):
+        old, new = previous['phases'][phase], result['phases'][phase]
+        if new['seconds'] > old['seconds'] * (1 + threshold) and new['seconds'] - old['seconds'] > NOISE_FLOOR:
+            regressions.append(f"{phase}: {old['seconds']:.4f} s -> {new['seconds']:.4f} s (revision {previous['revision']})")
+        if sum(new['queries'].values()) > sum(old['queries'].values()):
+            regressions.append(f"{phase}: {sum(old['queries'].values())} -> {sum(new['queries'].values())} queries (revision {previous['revision']})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LOC pipeline of today.py against a local stand-in GraphQL server')
+    parser.add_argument('--repos', type=int, default=120, help='repositories the synthetic user has access to')
+    parser.add_argument('--commits', type=int, default=800, help='most commits on any one repository (each gets a random count up to this)')
+    parser.add_argument('--own-share', type=float, default=0.4, help='share of commits authored by the synthetic user')
+    parser.add_argument('--new-commits', type=int, default=5, help='commits pushed between the warm and incremental runs')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the server waits before answering each request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 502 or a secondary rate limit')
+    parser.add_argument('--rate-limit', type=int, default=5000, help='rateLimit points the server starts with, to see repositories being deferred')
+    parser.add_argument('--workers', type=int, help='overrides LOC_WORKERS')
+    parser.add_argument('--batch-size', type=int, help='overrides LOC_BATCH_SIZE')
+    parser.add_argument('--language-stats', action='store_true', help='also build the per-language stats (one REST request per commit)')
+    parser.add_argument('--seed', type=int, default=2002)
+    parser.add_argument('--history', default=HISTORY_FILE, help='JSON lines file the results are appended to and compared against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='how much slower a phase may get before it counts as a regression')
+    parser.add_argument('--no-record', action='store_true', help="compare against the history file, but don't append to it")
+    args = parser.parse_args()
+
+    login = 'benchmark-user'
+    user = synthetic_user(login, args.repos, args.commits, args.own_share, args.seed)
+    server = start_server(user, args.latency, args.error_rate, args.seed, args.rate_limit)
+    os.environ.update({'USER_NAME': login, 'ACCESS_TOKEN': 'benchmark', 'GITHUB_GRAPHQL_URL': f'http://127.0.0.1:{server.server_address[1]}/graphql',
+                       'GITHUB_API_URL': f'http://127.0.0.1:{server.server_address[1]}'})
+    if args.language_stats: os.environ['LANGUAGE_STATS'] = '1'
+    os.environ.setdefault('REST_POINTS_PER_MINUTE', '1000000') # the stand-in has no REST secondary limit, and a minute of pacing would swamp the timings
+    if args.workers is not None: os.environ['LOC_WORKERS'] = str(args.workers)
+    if args.batch_size is not None: os.environ['LOC_BATCH_SIZE'] = str(args.batch_size)
+    history_file = os.path.abspath(args.history)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import today
+    today.OWNER_ID = {'id': OWNER_ID}
+
+    phases = {}
+    with tempfile.TemporaryDirectory() as directory: # today.py reads and writes cache/ relative to the working directory
+        cwd = os.getcwd()
+        os.chdir(directory)
+        os.mkdir('cache')
+        try:
+            phases['cold'] = timed_run(today, server)
+            phases['warm'] = timed_run(today, server)
+            add_commits(user, args.new_commits, args.seed)
+            phases['incremental'] = timed_run(today, server)
+        finally:
+            os.chdir(cwd)
+
+    print('Benchmark:', args.repos, 'repositories, up to', args.commits, 'commits each,', '%.0f ms' % (args.latency * 1000), 'latency,', '%.0f%%' % (args.error_rate * 100), 'errors')
+    for phase, result in phases.items():
+        print('{:<23}'.format('   ' + phase + ':'), '{:>10}'.format('%.4f s' % result['seconds']), '{:>6}'.format(sum(result['queries'].values())), 'queries',
+              '{:>6}'.format(result['http_requests']), 'HTTP requests', '{:>10}'.format('{:,}'.format(result['bytes'])), 'bytes',
+              '{:>6}'.format(result['deferred']), 'deferred')
+        for funct_name, count in result['queries'].items():
+            if count: print('{:<28}'.format('      ' + funct_name + ':'), '{:>6}'.format(count))
+    expected = list(expected_loc(user))
+    if phases['incremental']['loc'] != expected and not phases['incremental']['deferred']:
+        print('LOC mismatch! Expected', expected, 'but today.py counted', phases['incremental']['loc'])
+        return 1
+    if args.language_stats and phases['incremental']['languages'] != expected[:2] and not phases['incremental']['deferred']:
+        print('Language stats mismatch! Expected', expected[:2], 'but the language stats add up to', phases['incremental']['languages'])
+        return 1
+
+    scenario = {key: getattr(args, key) for key in ('repos', 'commits', 'own_share', 'new_commits', 'latency', 'error_rate', 'rate_limit', 'workers', 'batch_size', 'seed')}
+    if args.language_stats: # only added when on, so the scenarios recorded before it existed still match
+        scenario['language_stats'] = True
+    result = {'scenario': scenario, 'revision': git_revision(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'phases': {phase: {key: value[key] for key in ('seconds', 'queries', 'http_requests', 'bytes', 'deferred')} for phase, value in phases.items()}}
+    regressions = compare(result, history_file, args.threshold)
+    for regression in regressions:
+        print('Regression:', regression)
+    if not args.no_record:
+        with open(history_file, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,66 @@
 import datetime
-from dateutil import relativedelta
 import requests
 import os
-from lxml import etree
+import re
 import time
 import hashlib
+import io
+import json
+import atexit
+import random
+import shutil
+import signal
+import sys
+import threading
+from array import array
+from collections import deque
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from xml.sax.saxutils import escape
+# lxml and dateutil are imported where they are used: a run where nothing changed only updates the age, and doesn't need lxml
 
 # Fine-grained personal access token with All Repositories access:
 # Account permissions: read:Followers, read:Starring, read:Watching
 # Repository permissions: read:Commit statuses, read:Contents, read:Issues, read:Metadata, read:Pull Requests
 # Issues and pull requests permissions not needed at the moment, but may be used in the future
-HEADERS = {'authorization': 'token '+ os.environ['ACCESS_TOKEN']}
-USER_NAME = os.environ['USER_NAME'] # 'Andrew6rant'
-QUERY_COUNT = {'user_getter': 0, 'follower_getter': 0, 'graph_repos_stars': 0, 'recursive_loc': 0, 'graph_commits': 0, 'loc_query': 0}
+# In batch mode (python today.py --batch accounts.txt), use_account() swaps these for each account in turn
+HEADERS = {'authorization': 'token '+ os.environ.get('ACCESS_TOKEN', '')}
+USER_NAME = os.environ.get('USER_NAME', '') # 'Andrew6rant'
+OWNER_ID = None # {'id': ...} of USER_NAME, set once the profile has been fetched
+API_URL = os.environ.get('GITHUB_GRAPHQL_URL', 'https://api.github.com/graphql') # benchmark.py points this at a local stand-in server
+LOC_WORKERS = int(os.environ.get('LOC_WORKERS', 8)) # How many requests cache_builder has in flight at the same time
+LOC_BATCH_SIZE = int(os.environ.get('LOC_BATCH_SIZE', 10)) # How many repositories share one commit history request
+AUTHOR_FILTER = os.environ.get('AUTHOR_FILTER', '1') != '0' # Have GitHub only send my own commits, instead of every commit on the branch
+CHECKPOINT_EVERY = int(os.environ.get('CHECKPOINT_EVERY', 25)) # Save the cache file after this many repositories are refreshed
+FULL_RUN = os.environ.get('FULL_RUN', '0') != '0' # Skip the fingerprint check, and always run every stage
+LANGUAGE_STATS = os.environ.get('LANGUAGE_STATS', '0') != '0' # Also break my LOC down by language, which costs one REST call per new commit
+LANGUAGE_STATS_LIMIT = int(os.environ.get('LANGUAGE_STATS_LIMIT', 1000)) # How many commits stats_builder looks up per run, the rest wait for the next run
+REST_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com') # GitHub Actions sets this, benchmark.py points it at its stand-in server
+MAX_RETRIES = int(os.environ.get('MAX_RETRIES', 5)) # How many times a failed or rate limited query is retried
+MAX_RETRY_WAIT = 300 # Give up instead of sleeping longer than this many seconds for one retry
+POINTS_PER_MINUTE = int(os.environ.get('POINTS_PER_MINUTE', 1800)) # GitHub's secondary rate limit allows 2,000 GraphQL points per minute
+REST_POINTS_PER_MINUTE = int(os.environ.get('REST_POINTS_PER_MINUTE', 800)) # and 900 REST points per minute (1 per GET), counted separately
+RATE_LIMIT_RESERVE = int(os.environ.get('RATE_LIMIT_RESERVE', 200)) # Hourly rateLimit points left untouched for anything else using the token
+RATE_LIMIT = {'remaining': None, 'reset_at': None, 'deferred': 0} # Latest rateLimit GitHub reported, and how many repositories were put off
+POINTS_SPENT = {'graphql': deque(), 'rest': deque()} # (time.monotonic(), cost) of every request sent in the last minute, per API, see rate_limit_pace
+QUERY_COUNT = {'fingerprint_query': 0, 'profile_getter': 0, 'history_page': 0, 'graph_commits': 0, 'loc_query': 0, 'commit_languages': 0}
+QUERY_TIME = {funct_id: 0.0 for funct_id in QUERY_COUNT} # Seconds spent waiting on the GitHub GraphQL API, per function
+COUNTER_LOCK = threading.Lock()
+SPANS = [] # Every stage and GraphQL call of this run, see record_span
+TRACE_FILE = os.environ.get('TRACE_FILE') # Where SPANS are written when the run ends: Chrome trace format if it ends in .json, otherwise JSON lines
+SESSION = None
+EXECUTOR = None
+NEW_COMMITS = {} # repository hash -> (my new commits as (oid, year), newest first, stop oid, whether it was reached) from this run's loc_refresh
+STATS_COLUMNS = {'commit': 'I', 'year': 'H', 'language': 'H', 'additions': 'I', 'deletions': 'I'} # array typecode of each column in a stats file
+EXTENSION_LANGUAGES = {
+    '.py': 'Python', '.ipynb': 'Jupyter Notebook', '.js': 'JavaScript', '.jsx': 'JavaScript', '.mjs': 'JavaScript', '.ts': 'TypeScript',
+    '.tsx': 'TypeScript', '.java': 'Java', '.kt': 'Kotlin', '.scala': 'Scala', '.c': 'C', '.h': 'C', '.cpp': 'C++', '.cc': 'C++',
+    '.hpp': 'C++', '.cs': 'C#', '.go': 'Go', '.rs': 'Rust', '.rb': 'Ruby', '.php': 'PHP', '.swift': 'Swift', '.lua': 'Lua',
+    '.r': 'R', '.jl': 'Julia', '.hs': 'Haskell', '.ex': 'Elixir', '.exs': 'Elixir', '.dart': 'Dart', '.sh': 'Shell', '.bash': 'Shell',
+    '.ps1': 'PowerShell', '.sql': 'SQL', '.html': 'HTML', '.htm': 'HTML', '.css': 'CSS', '.scss': 'SCSS', '.vue': 'Vue',
+    '.svelte': 'Svelte', '.md': 'Markdown', '.tex': 'TeX', '.json': 'JSON', '.yml': 'YAML', '.yaml': 'YAML', '.toml': 'TOML',
+    '.xml': 'XML', '.svg': 'SVG'
+} # Anything else is counted as 'Other'
 
 
 def daily_readme(birthday):
@@ -20,6 +68,7 @@ def daily_readme(birthday):
     Returns the length of time since I was born
     e.g. 'XX years, XX months, XX days'
     """
+    from dateutil import relativedelta
     diff = relativedelta.relativedelta(datetime.datetime.today(), birthday)
     return '{} {}, {} {}, {} {}{}'.format(
         diff.years, 'year' + format_plural(diff.years), 
@@ -40,11 +89,180 @@ def format_plural(unit):
     return 's' if unit != 1 else ''
 
 
+def session():
+    """
+    Returns the requests.Session shared by every query (and every account, in batch mode: the token is sent per request)
+    Connections are kept alive and pooled, so the TLS handshake is only paid once per worker thread instead of once per query
+    """
+    global SESSION
+    with COUNTER_LOCK:
+        if SESSION is None:
+            SESSION = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, LOC_WORKERS))
+            SESSION.mount('https://', adapter)
+            SESSION.mount('http://', adapter)
+    return SESSION
+
+
+def executor():
+    """
+    Returns the thread pool shared by every call to loc_refresh, so batch mode doesn't start new worker threads for each account
+    """
+    global EXECUTOR
+    with COUNTER_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(max_workers=max(1, LOC_WORKERS))
+    return EXECUTOR
+
+
+def graphql_post(func_name, query, variables, cost=1):
+    """
+    Sends a query to GitHub's GraphQL v4 API, see api_request
+    cost is roughly how many rateLimit points the query will use, and is used to pace queries under POINTS_PER_MINUTE
+    """
+    return api_request(func_name, 'graphql', 'POST', API_URL, cost, json={'query': query, 'variables':variables})
+
+
+def api_request(func_name, category, method, url, cost=1, **kwargs):
+    """
+    Sends a request to GitHub's API through the shared session, and records how long it took in QUERY_TIME and as a span of category
+    Server errors, dropped connections and rate limits are retried with exponential backoff, up to MAX_RETRIES times
+    Returns the last response, whether or not it succeeded
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limit_pace(cost, category)
+        start, wall_start, request = time.perf_counter(), time.time(), None
+        try:
+            request = session().request(method, url, headers=HEADERS, timeout=60, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(retry_wait(None, attempt))
+            continue
+        finally:
+            query_time(func_name, time.perf_counter() - start)
+            record_span(func_name, category, wall_start, time.perf_counter() - start, attempt=attempt,
+                        status=request.status_code if request is not None else None,
+                        bytes=len(request.content) if request is not None else 0,
+                        cost=rate_limit_update(request) if category == 'graphql' else None)
+        if attempt == MAX_RETRIES or not should_retry(request):
+            return request
+        wait = retry_wait(request, attempt)
+        if wait > MAX_RETRY_WAIT:
+            return request
+        time.sleep(wait)
+
+
+def rate_limit_update(request):
+    """
+    Stores the remaining rateLimit points and reset time from a successful query in RATE_LIMIT
+    Returns the rateLimit cost GitHub charged for the query, or None if the response doesn't have one
+    """
+    if request is None or request.status_code != 200:
+        return None
+    try:
+        rate_limit = response_json(request)['data']['rateLimit']
+        with COUNTER_LOCK:
+            if RATE_LIMIT['reset_at'] == rate_limit['resetAt']: # responses from other threads can arrive out of order
+                RATE_LIMIT['remaining'] = min(RATE_LIMIT['remaining'], rate_limit['remaining'])
+            else:
+                RATE_LIMIT['remaining'], RATE_LIMIT['reset_at'] = rate_limit['remaining'], rate_limit['resetAt']
+        return rate_limit['cost']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def response_json(request):
+    """
+    Returns the decoded JSON body of a response, decoding it only the first time
+    rate_limit_update and the function that sent the query share the one decoded copy, instead of each calling request.json()
+    """
+    if not hasattr(request, 'decoded'):
+        request.decoded = json.loads(request.content)
+    return request.decoded
+
+
+def rate_limit_allows(cost):
+    """
+    Returns True if a query of about cost points fits in the hourly rateLimit budget, keeping RATE_LIMIT_RESERVE points spare
+    Before the first response, or once the reset time has passed, the budget is assumed to be fine
+    """
+    with COUNTER_LOCK:
+        if RATE_LIMIT['remaining'] is None:
+            return True
+        if datetime.datetime.utcnow() >= datetime.datetime.strptime(RATE_LIMIT['reset_at'], '%Y-%m-%dT%H:%M:%SZ'):
+            return True
+        return RATE_LIMIT['remaining'] - cost >= RATE_LIMIT_RESERVE
+
+
+def rate_limit_pace(cost, category='graphql'):
+    """
+    Sleeps until a request of about cost points can be sent without going over the per minute limit of its API in the last minute
+    GraphQL queries ('graphql') are paced under POINTS_PER_MINUTE and REST requests ('rest') under REST_POINTS_PER_MINUTE,
+    since GitHub counts the two separately, so REST lookups never hold up GraphQL queries
+    """
+    spent_points, limit = POINTS_SPENT[category], REST_POINTS_PER_MINUTE if category == 'rest' else POINTS_PER_MINUTE
+    while True:
+        with COUNTER_LOCK:
+            now = time.monotonic()
+            while spent_points and now - spent_points[0][0] >= 60:
+                spent_points.popleft()
+            if not spent_points or sum(spent for __, spent in spent_points) + cost <= limit:
+                spent_points.append((now, cost))
+                return
+            wait_time = 60 - (now - spent_points[0][0])
+        time.sleep(wait_time)
+
+
+class RateLimitError(Exception):
+    """
+    Raised when GitHub still refuses a query because of a rate limit after it has been retried
+    """
+
+
+class ServerError(Exception):
+    """
+    Raised when GitHub still answers a query with a server error (5xx) after it has been retried
+    """
+
+
+def should_retry(request):
+    """
+    Returns True if the response is a temporary failure: a server error, or a primary or secondary rate limit
+    Other 403s (e.g. missing token permissions) will fail the same way again, so they are not retried
+    """
+    if request.status_code in (500, 502, 503, 504, 429):
+        return True
+    if request.status_code == 403:
+        return 'Retry-After' in request.headers or request.headers.get('X-RateLimit-Remaining') == '0' or 'rate limit' in request.text.lower()
+    return False
+
+
+def rate_limited(request):
+    """
+    Returns True if the response is a primary or secondary rate limit, as opposed to a server error
+    """
+    return request.status_code in (403, 429) and should_retry(request)
+
+
+def retry_wait(request, attempt):
+    """
+    Returns how many seconds to sleep before the next attempt
+    Uses Retry-After if GitHub sent one, then X-RateLimit-Reset if the rate limit is used up, otherwise exponential backoff with jitter
+    """
+    if request is not None:
+        if 'Retry-After' in request.headers:
+            return float(request.headers['Retry-After'])
+        if request.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in request.headers:
+            return max(0.0, float(request.headers['X-RateLimit-Reset']) - time.time()) + 1
+    return 2 ** attempt + random.random()
+
+
 def simple_request(func_name, query, variables):
     """
     Returns a request, or raises an Exception if the response does not succeed.
     """
-    request = requests.post('https://api.github.com/graphql', json={'query': query, 'variables':variables}, headers=HEADERS)
+    request = graphql_post(func_name, query, variables)
     if request.status_code == 200:
         return request
     raise Exception(func_name, ' has failed with a', request.status_code, request.text, QUERY_COUNT)
@@ -64,129 +282,206 @@ def graph_commits(start_date, end_date):
                 }
             }
         }
+        rateLimit {
+            cost
+            remaining
+            resetAt
+        }
     }'''
     variables = {'start_date': start_date,'end_date': end_date, 'login': USER_NAME}
     request = simple_request(graph_commits.__name__, query, variables)
-    return int(request.json()['data']['user']['contributionsCollection']['contributionCalendar']['totalContributions'])
+    return int(response_json(request)['data']['user']['contributionsCollection']['contributionCalendar']['totalContributions'])
 
 
-def graph_repos_stars(count_type, owner_affiliation, cursor=None, add_loc=0, del_loc=0):
+def history_page(repos):
     """
-    Uses GitHub's GraphQL v4 API to return my total repository, star, or lines of code count.
+    Uses GitHub's GraphQL v4 API to fetch one page of 100 commits from each of several repositories in a single request
+    repos is a list of (owner, repo_name, cursor), and each repository gets its own alias (r0, r1, ...) in the query
+    With AUTHOR_FILTER, GitHub filters the history down to commits authored by OWNER_ID (and totalCount counts only those),
+    so commits by other people are never sent, decoded or paged through
+    Returns a list in the same order as repos, with None for every empty repository and otherwise
+    (commits, cursor of the next page or None, totalCount of the history), where each commit is an (oid, author id, additions, deletions, committed date) tuple, so the decoded page can be dropped straight away
     """
-    query_count('graph_repos_stars')
+    query_count('history_page')
+    parameters, aliases, variables = [], [], {}
+    author = ''
+    if AUTHOR_FILTER:
+        parameters.append('$author: CommitAuthor')
+        variables['author'] = OWNER_ID
+        author = ', author: $author'
+    for index, (owner, repo_name, cursor) in enumerate(repos):
+        parameters.append(f'$owner{index}: String!, $repo_name{index}: String!, $cursor{index}: String')
+        aliases.append(f'''
+        r{index}: repository(name: $repo_name{index}, owner: $owner{index}) {{
+            defaultBranchRef {{
+                target {{
+                    ... on Commit {{
+                        history(first: 100, after: $cursor{index}{author}) {{
+                            ...HistoryPage
+                        }}
+                    }}
+                }}
+            }}
+        }}''')
+        variables.update({f'owner{index}': owner, f'repo_name{index}': repo_name, f'cursor{index}': cursor})
     query = '''
-    query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String) {
-        user(login: $login) {
-            repositories(first: 100, after: $cursor, ownerAffiliations: $owner_affiliation) {
-                totalCount
-                edges {
-                    node {
-                        ... on Repository {
-                            nameWithOwner
-                            stargazers {
-                                totalCount
-                            }
-                        }
-                    }
+    query (''' + ', '.join(parameters) + ''') {''' + ''.join(aliases) + '''
+        rateLimit {
+            cost
+            remaining
+            resetAt
+        }
+    }
+    fragment HistoryPage on CommitHistoryConnection {
+        totalCount
+        edges {
+            node {
+                ... on Commit {
+                    committedDate
+                    oid
                 }
-                pageInfo {
-                    endCursor
-                    hasNextPage
+                author {
+                    user {
+                        id
+                    }
                 }
+                deletions
+                additions
             }
         }
+        pageInfo {
+            endCursor
+            hasNextPage
+        }
     }'''
-    variables = {'owner_affiliation': owner_affiliation, 'login': USER_NAME, 'cursor': cursor}
-    request = simple_request(graph_repos_stars.__name__, query, variables)
+    request = graphql_post(history_page.__name__, query, variables, len(repos)) # I don't use simple_request(), because rate limits get their own exception
     if request.status_code == 200:
-        if count_type == 'repos':
-            return request.json()['data']['user']['repositories']['totalCount']
-        elif count_type == 'stars':
-            return stars_counter(request.json()['data']['user']['repositories']['edges'])
+        pages, data = [], response_json(request)['data']
+        for index in range(len(repos)):
+            repository = data[f'r{index}']
+            if repository is None or repository['defaultBranchRef'] is None: # Only count commits if repo isn't empty (or still exists)
+                pages.append(None)
+                continue
+            history = repository['defaultBranchRef']['target']['history']
+            commits = [(node['oid'], node['author']['user'] and node['author']['user']['id'], node['additions'], node['deletions'],
+                        node['committedDate']) for node in (edge['node'] for edge in history['edges'])]
+            pages.append((commits, history['pageInfo']['endCursor'] if history['pageInfo']['hasNextPage'] else None, history['totalCount']))
+        return pages
+    if rate_limited(request): # still rate limited after retrying
+        raise RateLimitError('Too many requests in a short amount of time!\nYou\'ve hit the non-documented anti-abuse limit!')
+    if should_retry(request): # still failing with a server error after retrying
+        raise ServerError('history_page() has failed with a', request.status_code, request.text, QUERY_COUNT)
+    raise Exception('history_page() has failed with a', request.status_code, request.text, QUERY_COUNT)
 
 
-def recursive_loc(owner, repo_name, data, cache_comment, addition_total=0, deletion_total=0, my_commits=0, cursor=None):
+def history_pager(repos, finished=(), deferred=None):
     """
-    Uses GitHub's GraphQL v4 API and cursor pagination to fetch 100 commits from a repository at a time
+    Generator that walks the default branch history of several repositories with cursor pagination (GraphQL can only search 100 commits at a time)
+    repos is a list of (owner, repo_name). The first page of every repository is fetched in one request, and each
+    follow-up request only asks for the repositories that still have a next page.
+    Yields (index into repos, list of (oid, author id, additions, deletions, committed date) commits, totalCount of the history) for each page.
+    Empty repositories yield nothing.
+    Adding an index to finished while it is being yielded stops paging that repository.
+    If the rateLimit budget runs out (or GitHub keeps rate limiting), paging stops and the unfinished indexes are added to deferred.
+    If a request keeps failing with a server error, the repositories are retried one per request,
+    so that only the repository that breaks the query is added to deferred
     """
-    query_count('recursive_loc')
-    query = '''
-    query ($repo_name: String!, $owner: String!, $cursor: String) {
-        repository(name: $repo_name, owner: $owner) {
-            defaultBranchRef {
-                target {
-                    ... on Commit {
-                        history(first: 100, after: $cursor) {
-                            totalCount
-                            edges {
-                                node {
-                                    ... on Commit {
-                                        committedDate
-                                    }
-                                    author {
-                                        user {
-                                            id
-                                        }
-                                    }
-                                    deletions
-                                    additions
-                                }
-                            }
-                            pageInfo {
-                                endCursor
-                                hasNextPage
-                            }
-                        }
-                    }
-                }
-            }
-        }
-    }'''
-    variables = {'repo_name': repo_name, 'owner': owner, 'cursor': cursor}
-    request = requests.post('https://api.github.com/graphql', json={'query': query, 'variables':variables}, headers=HEADERS) # I cannot use simple_request(), because I want to save the file before raising Exception
-    if request.status_code == 200:
-        if request.json()['data']['repository']['defaultBranchRef'] != None: # Only count commits if repo isn't empty
-            return loc_counter_one_repo(owner, repo_name, data, cache_comment, request.json()['data']['repository']['defaultBranchRef']['target']['history'], addition_total, deletion_total, my_commits)
-        else: return 0
-    force_close_file(data, cache_comment) # saves what is currently in the file before this program crashes
-    if request.status_code == 403:
-        raise Exception('Too many requests in a short amount of time!\nYou\'ve hit the non-documented anti-abuse limit!')
-    raise Exception('recursive_loc() has failed with a', request.status_code, request.text, QUERY_COUNT)
+    cursors, single = {index: None for index in range(len(repos))}, False
+    while cursors:
+        batch = list(cursors.items())[:1] if single else list(cursors.items())
+        try:
+            if not rate_limit_allows(len(batch)):
+                raise RateLimitError('The rateLimit budget for this run has been used up')
+            pages = history_page([repos[index] + (cursor,) for index, cursor in batch])
+        except RateLimitError:
+            if deferred is None:
+                raise
+            deferred.update(cursors)
+            return
+        except ServerError:
+            if len(batch) > 1: # one of the repositories may be too big for GitHub to answer in time, so find out which
+                single = True
+                continue
+            if deferred is None:
+                raise
+            deferred.add(batch[0][0])
+            del cursors[batch[0][0]]
+            continue
+        for (index, __), page in zip(batch, pages):
+            del cursors[index]
+            if page is None:
+                continue
+            commits, cursor, total_count = page
+            yield index, commits, total_count
+            if index in finished or commits == [] or cursor is None:
+                continue
+            cursors[index] = cursor
 
 
-def loc_counter_one_repo(owner, repo_name, data, cache_comment, history, addition_total, deletion_total, my_commits):
+def loc_counter(repos):
     """
-    Recursively call recursive_loc (since GraphQL can only search 100 commits at a time) 
+    Folds every page from history_pager into running totals per repository, one page in memory at a time
     only adds the LOC value of commits authored by me
+    repos is a list of (owner, repo_name, stop_oid, stored_count). History is newest first, so a repository stops paging as soon as
+    its stop_oid (the newest commit seen last time, which with AUTHOR_FILTER is my newest commit) is reached.
+    History is ordered by date rather than ancestry though: commits merged in from a branch can be older than stop_oid,
+    and are listed after it. So stored_count (my commits with AUTHOR_FILTER, otherwise all commits, as of last time) plus the
+    commits paged before stop_oid has to add up to the history's totalCount, and a repository where it doesn't is paged again in full.
+    Returns, in the same order as repos, (additions, deletions, my commits, newest commit oid, whether stop_oid was reached,
+    (oid, year) of my commits newest first, only collected for stats_builder if LANGUAGE_STATS is on),
+    0 if the repository is empty, or None if it was deferred to the next run (rate limit, or GitHub kept failing on it)
     """
-    for node in history['edges']:
-        if node['node']['author']['user'] == OWNER_ID:
-            my_commits += 1
-            addition_total += node['node']['additions']
-            deletion_total += node['node']['deletions']
+    totals = [[0, 0, 0, None, False, []] for _ in repos]
+    paged, total_counts = [0] * len(repos), [0] * len(repos)
+    finished, deferred = set(), set()
+    for index, commits, total_count in history_pager([(owner, repo_name) for owner, repo_name, __, __ in repos], finished, deferred):
+        total = totals[index]
+        total_counts[index] = total_count
+        if total[3] is None:
+            total[3] = commits[0][0] if commits else '-'
+        for oid, author, additions, deletions, committed_date in commits:
+            if oid == repos[index][2]:
+                total[4] = True
+                finished.add(index)
+                break
+            paged[index] += 1
+            if author == OWNER_ID['id']:
+                total[2] += 1
+                total[0] += additions
+                total[1] += deletions
+                if LANGUAGE_STATS:
+                    total[5].append((oid, int(committed_date[:4])))
+    results = [None if index in deferred else 0 if total[3] is None else tuple(total) for index, total in enumerate(totals)]
+    missed = [index for index, total in enumerate(totals) if total[4] and index not in deferred and repos[index][3] + paged[index] != total_counts[index]]
+    if missed: # some commits are older than stop_oid, so start those repositories again from zero
+        for index, loc in zip(missed, loc_counter([repos[index][:2] + (None, 0) for index in missed])):
+            results[index] = loc
+    return results
 
-    if history['edges'] == [] or not history['pageInfo']['hasNextPage']:
-        return addition_total, deletion_total, my_commits
-    else: return recursive_loc(owner, repo_name, data, cache_comment, addition_total, deletion_total, my_commits, history['pageInfo']['endCursor'])
 
-
-def loc_query(owner_affiliation, comment_size=0, force_cache=False, cursor=None, edges=[]):
+def loc_query(owner_affiliation):
     """
     Uses GitHub's GraphQL v4 API to query all the repositories I have access to (with respect to owner_affiliation)
     Queries 60 repos at a time, because larger queries give a 502 timeout error and smaller queries send too many
     requests and also give a 502 error.
-    Returns the total number of lines of code in all repositories
+    Returns {'totalCount': number of repositories, 'edges': every repository}, where each repository has its owner,
+    stargazer count and default branch commit count, so later stages never need to page through the repositories again
     """
-    query_count('loc_query')
     query = '''
     query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String) {
         user(login: $login) {
             repositories(first: 60, after: $cursor, ownerAffiliations: $owner_affiliation) {
+            totalCount
             edges {
                 node {
                     ... on Repository {
                         nameWithOwner
+                        owner {
+                            login
+                        }
+                        stargazers {
+                            totalCount
+                        }
                         defaultBranchRef {
                             target {
                                 ... on Commit {
@@ -205,23 +500,33 @@ def loc_query(owner_affiliation, comment_size=0, force_cache=False, cursor=None,
                 }
             }
         }
+        rateLimit {
+            cost
+            remaining
+            resetAt
+        }
     }'''
-    variables = {'owner_affiliation': owner_affiliation, 'login': USER_NAME, 'cursor': cursor}
-    request = simple_request(loc_query.__name__, query, variables)
-    if request.json()['data']['user']['repositories']['pageInfo']['hasNextPage']:   # If repository data has another page
-        edges += request.json()['data']['user']['repositories']['edges']            # Add on to the LoC count
-        return loc_query(owner_affiliation, comment_size, force_cache, request.json()['data']['user']['repositories']['pageInfo']['endCursor'], edges)
-    else:
-        return cache_builder(edges + request.json()['data']['user']['repositories']['edges'], comment_size, force_cache)
+    cursor, edges = None, []
+    while True: # If repository data has another page, add on to the list
+        query_count('loc_query')
+        variables = {'owner_affiliation': owner_affiliation, 'login': USER_NAME, 'cursor': cursor}
+        repositories = response_json(simple_request(loc_query.__name__, query, variables))['data']['user']['repositories']
+        edges += repositories['edges']
+        if not repositories['pageInfo']['hasNextPage']:
+            return {'totalCount': repositories['totalCount'], 'edges': edges}
+        cursor = repositories['pageInfo']['endCursor']
 
 
-def cache_builder(edges, comment_size, force_cache, loc_add=0, loc_del=0):
+def cache_builder(edges, comment_size, force_cache, loc_add=0, loc_del=0, workers=LOC_WORKERS):
     """
     Checks each repository in edges to see if it has been updated since the last time it was cached
-    If it has, run recursive_loc on that repository to update the LOC count
+    If it has, run loc_counter on that repository to update the LOC count
+    Up to workers requests are in flight at the same time
+    Each line of the cache file is: repository hash, total commits, my commits, LOC added, LOC deleted, newest commit oid
+    Lines are looked up by repository hash, so adding or deleting a repository only adds or drops that repository's line
     """
     cached = True # Assume all repositories are cached
-    filename = 'cache/'+hashlib.sha256(USER_NAME.encode('utf-8')).hexdigest()+'.txt' # Create a unique filename for each user
+    filename = cache_filename()
     try:
         with open(filename, 'r') as f:
             data = f.readlines()
@@ -229,31 +534,28 @@ def cache_builder(edges, comment_size, force_cache, loc_add=0, loc_del=0):
         data = []
         if comment_size > 0:
             for _ in range(comment_size): data.append('This line is a comment block. Write whatever you want here.\n')
-        with open(filename, 'w') as f:
-            f.writelines(data)
-
-    if len(data)-comment_size != len(edges) or force_cache: # If the number of repos has changed, or force_cache is True
-        cached = False
-        flush_cache(edges, filename, comment_size)
-        with open(filename, 'r') as f:
-            data = f.readlines()
+        write_cache(filename, data)
 
+    lookup_start, wall_start = time.perf_counter(), time.time()
     cache_comment = data[:comment_size] # save the comment block
-    data = data[comment_size:] # remove those lines
+    cache = {} if force_cache else cache_index(data[comment_size:]) # force_cache starts every repository from zero
+    NEW_COMMITS.clear()
+    data = []
+    stale = []
     for index in range(len(edges)):
-        repo_hash, commit_count, *__ = data[index].split()
-        if repo_hash == hashlib.sha256(edges[index]['node']['nameWithOwner'].encode('utf-8')).hexdigest():
-            try:
-                if int(commit_count) != edges[index]['node']['defaultBranchRef']['target']['history']['totalCount']:
-                    # if commit count has changed, update loc for that repo
-                    owner, repo_name = edges[index]['node']['nameWithOwner'].split('/')
-                    loc = recursive_loc(owner, repo_name, data, cache_comment)
-                    data[index] = repo_hash + ' ' + str(edges[index]['node']['defaultBranchRef']['target']['history']['totalCount']) + ' ' + str(loc[2]) + ' ' + str(loc[0]) + ' ' + str(loc[1]) + '\n'
-            except TypeError: # If the repo is empty
-                data[index] = repo_hash + ' 0 0 0 0\n'
-    with open(filename, 'w') as f:
-        f.writelines(cache_comment)
-        f.writelines(data)
+        repo_hash = hashlib.sha256(edges[index]['node']['nameWithOwner'].encode('utf-8')).hexdigest()
+        if repo_hash not in cache: # a new repository, or force_cache is True
+            cached = False
+        data.append(cache.get(repo_hash, repo_hash + ' 0 0 0 0\n'))
+        try:
+            if int(data[index].split()[1]) != edges[index]['node']['defaultBranchRef']['target']['history']['totalCount']:
+                stale.append(index) # if commit count has changed, update loc for that repo
+        except TypeError: # If the repo is empty
+            data[index] = repo_hash + ' 0 0 0 0\n'
+    record_span('cache_lookup', 'cache', wall_start, time.perf_counter() - lookup_start,
+                hits=len(edges) - len(stale), misses=len(stale), new=sum(1 for index in range(len(edges)) if data[index].split()[0] not in cache))
+    loc_refresh(edges, stale, data, cache_comment, workers)
+    write_cache(filename, cache_comment + data)
     for line in data:
         loc = line.split()
         loc_add += int(loc[3])
@@ -261,102 +563,481 @@ def cache_builder(edges, comment_size, force_cache, loc_add=0, loc_del=0):
     return [loc_add, loc_del, loc_add - loc_del, cached]
 
 
-def flush_cache(edges, filename, comment_size):
+def loc_refresh(edges, stale, data, cache_comment, workers=LOC_WORKERS, batch_size=LOC_BATCH_SIZE):
     """
-    Wipes the cache file
-    This is called when the number of repositories changes or when the file is first created
+    Runs loc_counter on every stale repository (given as indexes into edges), batch_size repositories per request
+    and with up to workers requests in flight on the shared thread pool
+    Each result is written back to its own index in data, so the cache file keeps the same order as edges
+    The cache file is saved every CHECKPOINT_EVERY repositories, and whenever the refresh crashes or is cancelled,
+    so the next run picks up from there: repositories that were refreshed are no longer stale.
+    Repositories with a stored commit oid are only paged back to that commit, and the new commits are added to the stored totals.
+    If that commit is no longer in the history (it was rewritten), the whole history has been paged and the totals are replaced.
+    Cheap repositories (fewest new commits) are refreshed first. Once the rateLimit budget can't cover the next batch,
+    the remaining repositories are deferred: they stay stale in the cache file and are refreshed by the next run.
+    Returns the number of deferred repositories
     """
-    with open(filename, 'r') as f:
-        data = []
-        if comment_size > 0:
-            data = f.readlines()[:comment_size] # only save the comment
-    with open(filename, 'w') as f:
-        f.writelines(data)
-        for node in edges:
-            f.write(hashlib.sha256(node['node']['nameWithOwner'].encode('utf-8')).hexdigest() + ' 0 0 0 0\n')
+    def refresh(batch):
+        repos = []
+        for index in batch:
+            owner, repo_name = edges[index]['node']['nameWithOwner'].split('/')
+            __, commit_count, *stored = data[index].split()
+            repos.append((owner, repo_name, stored[3] if len(stored) > 3 else None, int(stored[0] if AUTHOR_FILTER else commit_count)))
+        return loc_counter(repos)
+
+    def pages(index): # how many 100 commit pages a repository is expected to need
+        __, commit_count, *stored = data[index].split()
+        new_commits = edges[index]['node']['defaultBranchRef']['target']['history']['totalCount'] - (int(commit_count) if len(stored) > 3 else 0)
+        return max(1, -(-new_commits // 100))
+
+    batch_size = max(1, batch_size)
+    stale = sorted(stale, key=pages)
+    pending = [stale[start:start + batch_size] for start in range(0, len(stale), batch_size)]
+    refreshed, checkpoint, deferred = 0, 0, 0
+    futures = {}
+    try:
+        while pending or futures:
+            while pending and len(futures) < max(1, workers): # only schedule what the budget still covers
+                if not rate_limit_allows(sum(pages(index) for index in pending[0])):
+                    deferred += sum(len(batch) for batch in pending)
+                    pending = []
+                    break
+                batch = pending.pop(0)
+                futures[executor().submit(refresh, batch)] = batch
+            if not futures:
+                break
+            done, __ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = futures.pop(future)
+                for index, loc in zip(batch, future.result()):
+                    if loc is None:
+                        deferred += 1
+                        continue
+                    if loc != 0 and LANGUAGE_STATS: # hand the new commits to stats_builder, so it doesn't page them again
+                        repo_hash, *stored = data[index].split()
+                        NEW_COMMITS[repo_hash] = (loc[5], stored[4] if len(stored) > 4 else None, loc[4])
+                    write_loc(edges, data, index, loc)
+                refreshed += len(batch)
+            if refreshed - checkpoint >= CHECKPOINT_EVERY:
+                write_cache(cache_filename(), cache_comment + data)
+                checkpoint = refreshed
+    except BaseException: # includes KeyboardInterrupt, which is also raised when the workflow is cancelled
+        for future in futures: future.cancel() # don't start any more repositories, the run is about to crash
+        force_close_file(data, cache_comment) # saves what is currently in the file before this program crashes
+        raise
+    with COUNTER_LOCK:
+        RATE_LIMIT['deferred'] += deferred
+    return deferred
+
+
+def write_loc(edges, data, index, loc):
+    """
+    Writes the result of loc_counter for the repository at index into its cache line
+    """
+    repo_hash = hashlib.sha256(edges[index]['node']['nameWithOwner'].encode('utf-8')).hexdigest()
+    if loc == 0: # If the repo is empty
+        data[index] = repo_hash + ' 0 0 0 0\n'
+        return
+    addition_total, deletion_total, my_commits, head_oid, found, __ = loc
+    if found: # only the new commits were counted, so add them on to what was stored
+        __, __, old_commits, old_add, old_del, *__ = data[index].split()
+        my_commits += int(old_commits)
+        addition_total += int(old_add)
+        deletion_total += int(old_del)
+    data[index] = repo_hash + ' ' + str(edges[index]['node']['defaultBranchRef']['target']['history']['totalCount']) + ' ' + str(my_commits) + ' ' + str(addition_total) + ' ' + str(deletion_total) + ' ' + head_oid + '\n'
+
+
+def cache_index(lines):
+    """
+    Returns the lines of the cache file (without the comment block) in a dictionary keyed by repository hash
+    """
+    cache = {}
+    for line in lines:
+        if line.strip():
+            cache[line.split()[0]] = line
+    return cache
 
 
 def add_archive():
     """
     Several repositories I have contributed to have since been deleted.
-    This function adds them using their last known data
+    This function adds them using their last known data, from the archive file of the current user (if there is one)
+    The archive never changes, so its totals are kept in a summary file next to it, along with the archive's hash,
+    and the archive is only parsed again when its hash no longer matches
+    Returns [LOC added, LOC deleted, LOC total, my commits, repositories]
     """
-    with open('cache/repository_archive.txt', 'r') as f:
-        data = f.readlines()
-    old_data = data
-    data = data[7:len(data)-3] # remove the comment block    
-    added_loc, deleted_loc, added_commits = 0, 0, 0
-    contributed_repos = len(data)
-    for line in data:
-        repo_hash, total_commits, my_commits, *loc = line.split()
-        added_loc += int(loc[0])
-        deleted_loc += int(loc[1])
-        if (my_commits.isdigit()): added_commits += int(my_commits)
-    added_commits += int(old_data[-1].split()[4][:-1])
+    filename = archive_filename()
+    if not os.path.exists(filename):
+        return [0, 0, 0, 0, 0]
+    with open(filename, 'rb') as f:
+        archive = f.read()
+    checksum = hashlib.sha256(archive).hexdigest()
+    summary_file = filename[:-len('.txt')] + '.summary'
+    if os.path.exists(summary_file):
+        with open(summary_file, 'r') as f:
+            summary = f.read().split()
+        if summary and summary[0] == checksum:
+            return [int(total) for total in summary[1:]]
+    totals = archive_totals(archive.decode('utf-8'))
+    write_cache(summary_file, [checksum + ' ' + ' '.join(str(total) for total in totals) + '\n'])
+    return totals
+
+
+def archive_totals(archive):
+    """
+    Adds up the repository lines of an archive file: hash, total commits, my commits (X if it wasn't saved), LOC added and LOC deleted
+    Any other line is a comment, except that "the total was N" adds N commits that couldn't be attributed to a repository
+    """
+    added_loc, deleted_loc, added_commits, contributed_repos = 0, 0, 0, 0
+    for my_commits, added, deleted in re.findall(r'^[0-9a-f]{64} \d+ (\d+|X) (\d+) (\d+)\s*$', archive, re.MULTILINE):
+        added_loc += int(added)
+        deleted_loc += int(deleted)
+        if my_commits.isdigit(): added_commits += int(my_commits)
+        contributed_repos += 1
+    unattributed = re.search(r'the total was (\d+)', archive)
+    if unattributed:
+        added_commits += int(unattributed.group(1))
     return [added_loc, deleted_loc, added_loc - deleted_loc, added_commits, contributed_repos]
 
+
 def force_close_file(data, cache_comment):
     """
     Forces the file to close, preserving whatever data was written to it
     This is needed because if this function is called, the program would've crashed before the file is properly saved and closed
     """
-    filename = 'cache/'+hashlib.sha256(USER_NAME.encode('utf-8')).hexdigest()+'.txt'
-    with open(filename, 'w') as f:
-        f.writelines(cache_comment)
-        f.writelines(data)
+    filename = cache_filename()
+    write_cache(filename, cache_comment + data)
     print('There was an error while writing to the cache file. The file,', filename, 'has had the partial data saved and closed.')
 
 
+def cache_filename():
+    """
+    Returns the cache file of the current user, named after the hash of their username
+    """
+    return 'cache/'+hashlib.sha256(USER_NAME.encode('utf-8')).hexdigest()+'.txt'
+
+
+def archive_filename():
+    """
+    Returns the archive file of the current user, which holds their deleted repositories, next to their cache file
+    """
+    return cache_filename()[:-len('.txt')] + '_archive.txt'
+
+
+def write_cache(filename, lines):
+    """
+    Writes the cache file atomically: the lines go to a temporary file first, which then replaces the cache file
+    A crash part way through writing leaves the previous cache file intact instead of a truncated one
+    """
+    with open(filename + '.tmp', 'w') as f:
+        f.writelines(lines)
+    os.replace(filename + '.tmp', filename)
+
+
+class LanguageStats(NamedTuple):
+    """
+    The per-commit, per-language LOC of my commits to one repository, stored column by column (see STATS_COLUMNS)
+    Row i says commit oids[commit[i]] (from year[i]) added additions[i] and deleted deletions[i] lines of languages[language[i]]
+    head is the newest commit covered, which is compared with the oid in the cache file to tell if the repository is stale
+    pending holds the [oid, year] of my commits up to head that haven't been looked up yet, oldest first
+    """
+    head: str
+    languages: list
+    oids: list
+    pending: list
+    commit: array
+    year: array
+    language: array
+    additions: array
+    deletions: array
+
+
+def stats_builder(edges, comment_size):
+    """
+    Brings the language stats of every repository in the cache file up to date, and returns them
+    A repository is stale when the newest commit in its stats file isn't the newest commit cache_builder stored for it,
+    or when its stats don't cover as many of my commits as the cache file counts (commits merged in behind the newest one).
+    The commits since then were just paged by loc_refresh (see NEW_COMMITS), so they are queued in pending without paging them again.
+    Only a repository whose stats are out of step with the cache file (e.g. LANGUAGE_STATS was just turned on, or its cache line
+    has no newest commit because it was counted by an older version) has its history paged here.
+    Pending commits are looked up with one REST call each (GraphQL has no per-file stats), oldest first and at most
+    LANGUAGE_STATS_LIMIT per run. Repositories with commits left over (or whose lookups kept failing) are deferred to the next run,
+    with the commits looked up so far saved.
+    Returns the LanguageStats of every repository in edges
+    """
+    with open(cache_filename(), 'r') as f:
+        cache = cache_index(f.readlines()[comment_size:])
+    stale, unpaged = [], []
+    for edge in edges:
+        repo_hash = hashlib.sha256(edge['node']['nameWithOwner'].encode('utf-8')).hexdigest()
+        line = cache.get(repo_hash, '').split()
+        if len(line) < 5 or line[2] == '0' or line[5:] == ['-']: # never counted (e.g. deferred), or none of my commits
+            continue
+        stats = read_stats(stats_filename(repo_hash))
+        if len(line) < 6: # counted before the cache file stored the newest commit, so only the stats file knows it
+            if stats.head is None or len(stats.oids) + len(stats.pending) != int(line[2]):
+                unpaged.append((edge['node']['nameWithOwner'], repo_hash))
+                continue
+        elif stats.head != line[5] or len(stats.oids) + len(stats.pending) != int(line[2]):
+            new_commits, stop_oid, found = NEW_COMMITS.get(repo_hash, (None, None, False))
+            if new_commits is None or (found and stop_oid != stats.head):
+                unpaged.append((edge['node']['nameWithOwner'], repo_hash))
+                continue
+            if not found: # the whole history was paged (a new or rewritten repository), so start again
+                stats = empty_stats()
+            stats = stats._replace(head=line[5], pending=stats.pending + [list(commit) for commit in reversed(new_commits)])
+        stale.append((edge['node']['nameWithOwner'], repo_hash, stats))
+
+    deferred = 0
+    for start in range(0, len(unpaged), LOC_BATCH_SIZE):
+        batch = unpaged[start:start + LOC_BATCH_SIZE]
+        for (name, repo_hash), loc in zip(batch, loc_counter([tuple(name.split('/')) + (None, 0) for name, __ in batch])):
+            if loc is None: # the rateLimit budget ran out while paging
+                deferred += 1
+            elif loc != 0:
+                stale.append((name, repo_hash, empty_stats()._replace(head=loc[3], pending=[list(commit) for commit in reversed(loc[5])])))
+
+    budget, all_stats = LANGUAGE_STATS_LIMIT, []
+    for name, repo_hash, stats in stale:
+        todo, done = stats.pending[:max(0, budget)], 0
+        try:
+            for (oid, year), languages in zip(todo, executor().map(commit_languages, [name] * len(todo), [oid for oid, __ in todo])):
+                add_commit_stats(stats, oid, year, languages)
+                done += 1
+            budget -= done
+        except RateLimitError: # the REST rate limit is used up, so every repository after this one waits for the next run
+            budget = 0
+        except (ServerError, requests.exceptions.ConnectionError, requests.exceptions.Timeout): # only this repository waits for the next run
+            budget -= done
+        if done < len(stats.pending):
+            deferred += 1
+        stats = stats._replace(pending=stats.pending[done:])
+        write_stats(stats_filename(repo_hash), stats)
+        all_stats.append(stats)
+    with COUNTER_LOCK:
+        RATE_LIMIT['deferred'] += deferred
+    return all_stats
+
+
+def commit_languages(name_with_owner, oid):
+    """
+    Uses GitHub's REST API to get the files changed by one commit, and adds up their additions and deletions by language
+    Commits that change more than 300 files are listed over several pages
+    Returns {language: [additions, deletions]}, or {} if GitHub can't show the commit (e.g. it was force pushed away, or its diff is too big),
+    so the commit is recorded without any rows instead of being looked up again every run
+    """
+    query_count('commit_languages')
+    languages = {}
+    url = REST_URL + '/repos/' + name_with_owner + '/commits/' + oid
+    while url:
+        request = api_request(commit_languages.__name__, 'rest', 'GET', url)
+        if request.status_code != 200:
+            if rate_limited(request): # still rate limited after retrying
+                raise RateLimitError('Too many requests in a short amount of time!\nYou\'ve hit the REST API rate limit!')
+            if should_retry(request): # still failing with a server error after retrying
+                raise ServerError('commit_languages() has failed with a', request.status_code, request.text, QUERY_COUNT)
+            if request.status_code in (404, 409, 422): # this commit can't be looked up, but the next one can
+                return {}
+            raise Exception('commit_languages() has failed with a', request.status_code, request.text, QUERY_COUNT)
+        for changed in response_json(request)['files']:
+            total = languages.setdefault(EXTENSION_LANGUAGES.get(os.path.splitext(changed['filename'])[1].lower(), 'Other'), [0, 0])
+            total[0] += changed['additions']
+            total[1] += changed['deletions']
+        url = request.links.get('next', {}).get('url')
+    return languages
+
+
+def add_commit_stats(stats, oid, year, languages):
+    """
+    Appends one row per language of a commit (the result of commit_languages) to the columns of stats
+    """
+    stats.oids.append(oid)
+    for language, (additions, deletions) in languages.items():
+        if language not in stats.languages:
+            stats.languages.append(language)
+        stats.commit.append(len(stats.oids) - 1)
+        stats.year.append(year)
+        stats.language.append(stats.languages.index(language))
+        stats.additions.append(additions)
+        stats.deletions.append(deletions)
+
+
+def stats_totals(all_stats, column):
+    """
+    Adds up additions and deletions over every row of every repository, grouped by column ('language' or 'year')
+    e.g. stats_totals(all_stats, 'year') is my LOC per year, without any more queries
+    Returns {language or year: [additions, deletions]}
+    """
+    totals = {}
+    for stats in all_stats:
+        for key, additions, deletions in zip(getattr(stats, column), stats.additions, stats.deletions):
+            total = totals.setdefault(stats.languages[key] if column == 'language' else key, [0, 0])
+            total[0] += additions
+            total[1] += deletions
+    return totals
+
+
+def language_summary(all_stats, count=3):
+    """
+    Returns my top languages by lines added, with their share of all lines added
+    e.g. 'Python 61%, JavaScript 20%, HTML 9%'
+    """
+    totals = sorted(stats_totals(all_stats, 'language').items(), key=lambda item: item[1][0], reverse=True)
+    added = sum(total[0] for __, total in totals) or 1
+    return ', '.join(f'{language} {round(100 * total[0] / added)}%' for language, total in totals[:count])
+
+
+def stats_filename(repo_hash):
+    """
+    Returns the stats file of a repository, in a folder next to the cache file of the current user
+    """
+    return cache_filename()[:-len('.txt')] + '_stats/' + repo_hash + '.bin'
+
+
+def empty_stats():
+    """
+    Returns a LanguageStats without any rows, for a repository that hasn't been looked up yet
+    """
+    return LanguageStats(None, [], [], [], *(array(typecode) for typecode in STATS_COLUMNS.values()))
+
+
+def read_stats(filename):
+    """
+    Reads a stats file: one line of JSON (head, languages, oids, pending, number of rows and byte order),
+    followed by each column of STATS_COLUMNS as a packed array
+    Returns an empty LanguageStats if the file doesn't exist yet
+    """
+    if not os.path.exists(filename):
+        return empty_stats()
+    with open(filename, 'rb') as f:
+        header = json.loads(f.readline())
+        columns = []
+        for typecode in STATS_COLUMNS.values():
+            column = array(typecode)
+            column.fromfile(f, header['rows'])
+            if header['byteorder'] != sys.byteorder:
+                column.byteswap()
+            columns.append(column)
+    return LanguageStats(header['head'], header['languages'], header['oids'], header['pending'], *columns)
+
+
+def write_stats(filename, stats):
+    """
+    Writes a stats file atomically (see read_stats for the layout), like write_cache
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    header = {'head': stats.head, 'languages': stats.languages, 'oids': stats.oids, 'pending': stats.pending, 'rows': len(stats.year), 'byteorder': sys.byteorder}
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for column in STATS_COLUMNS:
+            getattr(stats, column).tofile(f)
+    os.replace(filename + '.tmp', filename)
+
+
 def stars_counter(data):
     """
     Count total stars in repositories owned by me
+    data is the list of repositories from loc_query, which also holds repositories I only contribute to
     """
     total_stars = 0
-    for node in data: total_stars += node['node']['stargazers']['totalCount']
+    for node in data:
+        if node['node']['owner']['login'].lower() == USER_NAME.lower():
+            total_stars += node['node']['stargazers']['totalCount']
     return total_stars
 
 
-def svg_overwrite(filename, age_data, commit_data, star_data, repo_data, contrib_data, follower_data, loc_data):
+def svg_overwrite(filenames, age_data, commit_data, stats, loc_data, language_data=None):
     """
     Parse SVG files and update elements with my age, commits, stars, repositories, and lines written
+    stats is the ProfileStats returned by profile_getter
+    language_data (from language_summary) is left blank if it is None, because LANGUAGE_STATS is off
+    The text of every element is formatted and justified once, then applied to each file in filenames (one per theme)
+    Returns the list of files that changed
+    """
+    fields = {}
+    if age_data is None: # no birthday, so blank the age the card was copied with
+        justify_format(fields, 'age_data', '')
+    else:
+        justify_format(fields, 'age_data', age_data, 49)
+    justify_format(fields, 'commit_data', commit_data, 22)
+    justify_format(fields, 'star_data', stats.stars, 14)
+    justify_format(fields, 'repo_data', stats.repos, 6)
+    justify_format(fields, 'contrib_data', stats.contributed)
+    justify_format(fields, 'follower_data', stats.followers, 10)
+    justify_format(fields, 'loc_data', loc_data[2], 9)
+    justify_format(fields, 'loc_add', loc_data[0])
+    justify_format(fields, 'loc_del', loc_data[1], 7)
+    if language_data is None:
+        justify_format(fields, 'language_data', '')
+    else:
+        justify_format(fields, 'language_data', language_data, 36)
+    return [filename for filename in filenames if svg_render(filename, fields)]
+
+
+def svg_render(filename, fields):
+    """
+    Parses the SVG file once, indexes the elements whose id is in fields, and sets their text
+    The file is only written if the result differs from what is already on disk, so unchanged cards are left alone
+    Returns True if the file was written
+    """
+    from lxml import etree
+    with open(filename, 'rb') as f:
+        original = f.read()
+    tree = etree.parse(io.BytesIO(original))
+    index = {}
+    for element in tree.getroot().iter():
+        if element.get('id') in fields:
+            index.setdefault(element.get('id'), element) # the first element with an id wins, like root.find() did
+    for element_id, new_text in fields.items():
+        if element_id in index:
+            index[element_id].text = new_text
+    output = etree.tostring(tree, encoding='UTF-8', xml_declaration=True)
+    if output == original:
+        return False
+    with open(filename, 'wb') as f:
+        f.write(output)
+    return True
+
+
+def svg_patch(filename, fields):
+    """
+    Sets the text of the elements whose id is in fields like svg_render does, but with a regular expression instead of lxml
+    Only used when nothing but the age changed, on files svg_render already wrote, so their layout is the one lxml produces
+    Returns True if the file was written
     """
-    tree = etree.parse(filename)
-    root = tree.getroot()
-    justify_format(root, 'commit_data', commit_data, 22)
-    justify_format(root, 'star_data', star_data, 14)
-    justify_format(root, 'repo_data', repo_data, 6)
-    justify_format(root, 'contrib_data', contrib_data)
-    justify_format(root, 'follower_data', follower_data, 10)
-    justify_format(root, 'loc_data', loc_data[2], 9)
-    justify_format(root, 'loc_add', loc_data[0])
-    justify_format(root, 'loc_del', loc_data[1], 7)
-    tree.write(filename, encoding='utf-8', xml_declaration=True)
+    with open(filename, 'r', encoding='utf-8', newline='') as f:
+        original = f.read()
+    output = svg_text(fields).sub(lambda match: match.group(1) + escape(fields[match.group(2)]), original)
+    if output == original:
+        return False
+    with open(filename, 'w', encoding='utf-8', newline='') as f:
+        f.write(output)
+    return True
 
 
-def justify_format(root, element_id, new_text, length=0):
+def svg_text(element_ids):
     """
-    Updates and formats the text of the element, and modifes the amount of dots in the previous element to justify the new text on the svg
+    Returns a regular expression matching the opening tag (group 1), id (group 2) and text (group 3) of the elements with these ids
+    Like every <tspan> justify_format fills in, the elements can't have child elements
+    """
+    return re.compile(r'(<[^<>]*\sid="(' + '|'.join(map(re.escape, element_ids)) + r')"[^<>]*>)([^<]*)(?=<)')
+
+
+def justify_format(fields, element_id, new_text, length=0):
+    """
+    Formats the text of the element, and sets the amount of dots in the previous element to justify the new text on the svg
+    Both are stored in fields, which maps element ids to their new text
     """
     if isinstance(new_text, int):
         new_text = f"{'{:,}'.format(new_text)}"
     new_text = str(new_text)
-    find_and_replace(root, element_id, new_text)
+    fields[element_id] = new_text
     just_len = max(0, length - len(new_text))
     if just_len <= 2:
         dot_map = {0: '', 1: ' ', 2: '. '}
         dot_string = dot_map[just_len]
     else:
         dot_string = ' ' + ('.' * just_len) + ' '
-    find_and_replace(root, f"{element_id}_dots", dot_string)
-
-
-def find_and_replace(root, element_id, new_text):
-    """
-    Finds the element in the SVG file and replaces its text with a new value
-    """
-    element = root.find(f".//*[@id='{element_id}']")
-    if element is not None:
-        element.text = new_text
+    fields[f"{element_id}_dots"] = dot_string
 
 
 def commit_counter(comment_size):
@@ -364,7 +1045,7 @@ def commit_counter(comment_size):
     Counts up my total commits, using the cache file created by cache_builder.
     """
     total_commits = 0
-    filename = 'cache/'+hashlib.sha256(USER_NAME.encode('utf-8')).hexdigest()+'.txt' # Use the same filename as cache_builder
+    filename = cache_filename() # Use the same filename as cache_builder
     with open(filename, 'r') as f:
         data = f.readlines()
     cache_comment = data[:comment_size] # save the comment block
@@ -374,37 +1055,128 @@ def commit_counter(comment_size):
     return total_commits
 
 
-def user_getter(username):
+class ProfileStats(NamedTuple):
     """
-    Returns the account ID and creation time of the user
+    Everything the SVG cards show about the account itself, from profile_getter
     """
-    query_count('user_getter')
+    id: str
+    created_at: str
+    followers: int
+    repos: int
+    contributed: int
+    stars: int
+
+
+def profile_getter(username, listing):
+    """
+    Returns the account ID, creation time, follower count, owned and contributed repository counts, and total stars of the user
+    The account fields come back in one query, and the contributed count and stars are read from listing (the result of loc_query)
+    """
+    query_count('profile_getter')
     query = '''
     query($login: String!){
         user(login: $login) {
             id
             createdAt
+            followers {
+                totalCount
+            }
+            repositories(ownerAffiliations: [OWNER]) {
+                totalCount
+            }
+        }
+        rateLimit {
+            cost
+            remaining
+            resetAt
         }
     }'''
-    variables = {'login': username}
-    request = simple_request(user_getter.__name__, query, variables)
-    return {'id': request.json()['data']['user']['id']}, request.json()['data']['user']['createdAt']
+    user = response_json(simple_request(profile_getter.__name__, query, {'login': username}))['data']['user']
+    return ProfileStats(user['id'], user['createdAt'], user['followers']['totalCount'], user['repositories']['totalCount'],
+                        listing['totalCount'], stars_counter(listing['edges']))
+
 
-def follower_getter(username):
+def fingerprint_query(username):
     """
-    Returns the number of followers of the user
+    Returns everything the cards show that can change on GitHub's side, in one small query per 100 owned repositories:
+    the follower count, stars of every owned repository, and the head commit and commit count of the most recently pushed repositories
+    A new commit anywhere moves its repository to the front, so only the first 100 are needed to notice it, but a star
+    can change on any owned repository, so those are paged through (by name, so the pages don't shift in between)
     """
-    query_count('follower_getter')
     query = '''
-    query($login: String!){
+    query Fingerprint($login: String!, $cursor: String, $first_page: Boolean!) {
         user(login: $login) {
-            followers {
+            followers @include(if: $first_page) {
                 totalCount
             }
+            owned: repositories(first: 100, after: $cursor, ownerAffiliations: [OWNER], orderBy: {field: NAME, direction: ASC}) {
+                totalCount
+                nodes {
+                    stargazerCount
+                }
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+            }
+            repositories(first: 100, ownerAffiliations: [OWNER, COLLABORATOR, ORGANIZATION_MEMBER], orderBy: {field: PUSHED_AT, direction: DESC}) @include(if: $first_page) {
+                totalCount
+                nodes {
+                    nameWithOwner
+                    defaultBranchRef {
+                        target {
+                            oid
+                            ... on Commit {
+                                history {
+                                    totalCount
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+        rateLimit {
+            cost
+            remaining
+            resetAt
         }
     }'''
-    request = simple_request(follower_getter.__name__, query, {'login': username})
-    return int(request.json()['data']['user']['followers']['totalCount'])
+    cursor, data = None, None
+    while True: # every page after the first only has the owned repositories
+        query_count('fingerprint_query')
+        variables = {'login': username, 'cursor': cursor, 'first_page': data is None}
+        user = response_json(simple_request(fingerprint_query.__name__, query, variables))['data']['user']
+        if data is None:
+            data = user
+        else:
+            data['owned']['nodes'] += user['owned']['nodes']
+        if not user['owned']['pageInfo']['hasNextPage']:
+            del data['owned']['pageInfo'] # the cursors aren't part of the fingerprint
+            return data
+        cursor = user['owned']['pageInfo']['endCursor']
+
+
+def card_fingerprint(data, filenames):
+    """
+    Hashes the result of fingerprint_query together with the cards in filenames (leaving out the age) and the archive file
+    If this matches the fingerprint saved by the last full run, the cards are up to date apart from the age
+    """
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8'))
+    if os.path.exists(archive_filename()):
+        with open(archive_filename(), 'rb') as f:
+            digest.update(f.read())
+    for filename in filenames:
+        with open(filename, 'r', encoding='utf-8', newline='') as f:
+            digest.update(svg_text(['age_data', 'age_data_dots']).sub(r'\1', f.read()).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fingerprint_filename():
+    """
+    Returns the file the fingerprint of the last full run is kept in, next to the cache file of the current user
+    """
+    return cache_filename()[:-len('.txt')] + '.fingerprint'
 
 
 def query_count(funct_id):
@@ -412,17 +1184,54 @@ def query_count(funct_id):
     Counts how many times the GitHub GraphQL API is called
     """
     global QUERY_COUNT
-    QUERY_COUNT[funct_id] += 1
+    with COUNTER_LOCK:
+        QUERY_COUNT[funct_id] += 1
+
+
+def query_time(funct_id, difference):
+    """
+    Adds up how long each function spends waiting on the GitHub GraphQL API, including retries
+    """
+    global QUERY_TIME
+    with COUNTER_LOCK:
+        QUERY_TIME[funct_id] += difference
 
 
 def perf_counter(funct, *args):
     """
-    Calculates the time it takes for a function to run
+    Calculates the time it takes for a function to run, and records it as a 'stage' span
     Returns the function result and the time differential
     """
-    start = time.perf_counter()
+    start, wall_start = time.perf_counter(), time.time()
     funct_return = funct(*args)
-    return funct_return, time.perf_counter() - start
+    difference = time.perf_counter() - start
+    record_span(funct.__name__, 'stage', wall_start, difference)
+    return funct_return, difference
+
+
+def record_span(name, category, start, duration, **args):
+    """
+    Records a span in SPANS: what ran (name and category), when it started (a time.time() timestamp),
+    how many seconds it took, which thread ran it, and any extra details in args
+    e.g. bytes received and rateLimit cost for a GraphQL call, or cache hits and misses for the cache lookup
+    """
+    with COUNTER_LOCK:
+        SPANS.append({'name': name, 'cat': category, 'start': start, 'duration': duration, 'thread': threading.get_ident(), 'args': args})
+
+
+def write_trace(filename):
+    """
+    Writes SPANS to filename, so separate runs can be kept and compared
+    A .json file gets the Chrome trace event format (open it in chrome://tracing or ui.perfetto.dev), anything else gets one JSON object per line
+    """
+    with open(filename, 'w') as f:
+        if filename.endswith('.json'):
+            events = [{'name': span['name'], 'cat': span['cat'], 'ph': 'X', 'ts': span['start'] * 1e6, 'dur': span['duration'] * 1e6,
+                       'pid': os.getpid(), 'tid': span['thread'], 'args': span['args']} for span in SPANS]
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        else:
+            for span in SPANS:
+                f.write(json.dumps(span) + '\n')
 
 
 def formatter(query_type, difference, funct_return=False, whitespace=0):
@@ -437,43 +1246,151 @@ def formatter(query_type, difference, funct_return=False, whitespace=0):
     return funct_return
 
 
-if __name__ == '__main__':
+def build_card(filenames, birthday=None):
     """
-    Andrew Grant (Andrew6rant), 2022-2025
+    Runs every stage for the current account (USER_NAME and HEADERS), printing how long each one took,
+    and writes the results into the SVG files in filenames. The age is only calculated if birthday is given, otherwise it is left blank.
+    If the fingerprint shows nothing changed since the last full run, only the age is updated
+    Returns the list of files that changed
     """
-    print('Calculation times:')
-    # define global variable for owner ID and calculate user's creation date
+    global OWNER_ID
+    fingerprint_data, fingerprint_time = perf_counter(fingerprint_query, USER_NAME)
+    fingerprint = card_fingerprint(fingerprint_data, filenames)
+    previous = None
+    if os.path.exists(fingerprint_filename()):
+        with open(fingerprint_filename(), 'r') as f:
+            previous = f.read().strip()
+    if fingerprint == previous and not FULL_RUN:
+        formatter('fingerprint (no change)', fingerprint_time)
+        fields = {}
+        if birthday is None:
+            justify_format(fields, 'age_data', '')
+        else:
+            age_data, age_time = perf_counter(daily_readme, birthday)
+            formatter('age calculation', age_time)
+            justify_format(fields, 'age_data', age_data, 49)
+        return [filename for filename in filenames if svg_patch(filename, fields)]
+
+    # define global variable for owner ID, and get the user's creation date, followers, repositories and stars
     # e.g {'id': 'MDQ6VXNlcjU3MzMxMTM0'} and 2019-11-03T21:15:07Z for username 'Andrew6rant'
-    user_data, user_time = perf_counter(user_getter, USER_NAME)
-    OWNER_ID, acc_date = user_data
+    listing, listing_time = perf_counter(loc_query, ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'])
+    stats, user_time = perf_counter(profile_getter, USER_NAME, listing)
+    OWNER_ID = {'id': stats.id}
     formatter('account data', user_time)
-    age_data, age_time = perf_counter(daily_readme, datetime.datetime(2002, 7, 5))
-    formatter('age calculation', age_time)
-    total_loc, loc_time = perf_counter(loc_query, ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'], 7)
+    age_data = None
+    if birthday is not None:
+        age_data, age_time = perf_counter(daily_readme, birthday)
+        formatter('age calculation', age_time)
+    total_loc, loc_time = perf_counter(cache_builder, listing['edges'], 7, False)
+    loc_time += listing_time
     formatter('LOC (cached)', loc_time) if total_loc[-1] else formatter('LOC (no cache)', loc_time)
     commit_data, commit_time = perf_counter(commit_counter, 7)
-    star_data, star_time = perf_counter(graph_repos_stars, 'stars', ['OWNER'])
-    repo_data, repo_time = perf_counter(graph_repos_stars, 'repos', ['OWNER'])
-    contrib_data, contrib_time = perf_counter(graph_repos_stars, 'repos', ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'])
-    follower_data, follower_time = perf_counter(follower_getter, USER_NAME)
+    language_data = None
+    if LANGUAGE_STATS:
+        all_stats, language_time = perf_counter(stats_builder, listing['edges'], 7)
+        language_data = language_summary(all_stats)
+        formatter('language stats', language_time)
+        print('   ' + language_data)
+        print('   ' + ', '.join(f"{year}: +{'{:,}'.format(total[0])} -{'{:,}'.format(total[1])}" for year, total in sorted(stats_totals(all_stats, 'year').items())))
 
     # several repositories that I've contributed to have since been deleted.
-    if OWNER_ID == {'id': 'MDQ6VXNlcjU3MzMxMTM0'}: # only calculate for user Andrew6rant
-        archived_data = add_archive()
-        for index in range(len(total_loc)-1):
-            total_loc[index] += archived_data[index]
-        contrib_data += archived_data[-1]
-        commit_data += int(archived_data[-2])
+    archived_data = add_archive()
+    for index in range(len(total_loc)-1):
+        total_loc[index] += archived_data[index]
+    stats = stats._replace(contributed=stats.contributed + archived_data[-1])
+    commit_data += archived_data[-2]
 
     for index in range(len(total_loc)-1): total_loc[index] = '{:,}'.format(total_loc[index]) # format added, deleted, and total LOC
 
-    svg_overwrite('dark_mode.svg', age_data, commit_data, star_data, repo_data, contrib_data, follower_data, total_loc[:-1])
-    svg_overwrite('light_mode.svg', age_data, commit_data, star_data, repo_data, contrib_data, follower_data, total_loc[:-1])
+    changed = svg_overwrite(filenames, age_data, commit_data, stats, total_loc[:-1], language_data)
+    if not RATE_LIMIT['deferred']: # a run that put repositories off isn't finished, so the next one can't be skipped
+        write_cache(fingerprint_filename(), [card_fingerprint(fingerprint_data, filenames) + '\n'])
+    return changed
+
+
+def use_account(username, token):
+    """
+    Switches every query, cache file and counter over to another account, for batch mode
+    The HTTP session and thread pool are kept, only the per-account state is reset
+    """
+    global USER_NAME, HEADERS, OWNER_ID
+    USER_NAME, HEADERS, OWNER_ID = username, {'authorization': 'token ' + token}, None
+    with COUNTER_LOCK:
+        for funct_id in QUERY_COUNT:
+            QUERY_COUNT[funct_id], QUERY_TIME[funct_id] = 0, 0.0
+        RATE_LIMIT.update({'remaining': None, 'reset_at': None, 'deferred': 0}) # every token has its own rate limit
+        for spent_points in POINTS_SPENT.values():
+            spent_points.clear()
+
+
+def read_accounts(filename):
+    """
+    Reads a batch file with one account per line: username, token, and optionally a birthday (YYYY-MM-DD)
+    A token written as $NAME is read from the environment variable NAME, so the file itself doesn't need to hold secrets
+    Blank lines and lines starting with # are skipped
+    """
+    accounts = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            username, token, *birthday = line.split()
+            if token.startswith('$'):
+                token = os.environ[token[1:]]
+            accounts.append((username, token, datetime.datetime.strptime(birthday[0], '%Y-%m-%d') if birthday else None))
+    return accounts
+
+
+def batch_main(accounts, output_dir='cards'):
+    """
+    Generates the cards of every (username, token, birthday) in accounts in this one process, sharing the HTTP session and thread pool
+    Each account gets its own cache file (named after its username, like always) and its own copy of the cards in output_dir/username/
+    Returns the number of accounts that failed
+    """
+    failures = 0
+    for username, token, birthday in accounts:
+        use_account(username, token)
+        directory = os.path.join(output_dir, username)
+        os.makedirs(directory, exist_ok=True)
+        filenames = []
+        for template in ['dark_mode.svg', 'light_mode.svg']:
+            filenames.append(os.path.join(directory, template))
+            if not os.path.exists(filenames[-1]):
+                shutil.copyfile(template, filenames[-1])
+        print(username + ':')
+        try:
+            changed = build_card(filenames, birthday)
+        except Exception as error: # one broken account shouldn't stop the rest of the team's cards
+            failures += 1
+            print('   failed:', error)
+            continue
+        print('   GitHub GraphQL API calls:', sum(QUERY_COUNT.values()), '| cards changed:', len(changed))
+    return failures
+
+
+if __name__ == '__main__':
+    """
+    Andrew Grant (Andrew6rant), 2022-2025
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # a cancelled workflow gets to save the cache file, see loc_refresh
+    if TRACE_FILE:
+        atexit.register(write_trace, TRACE_FILE) # also runs if the program crashes, so failed runs can be looked at too
+    if len(sys.argv) > 2 and sys.argv[1] == '--batch': # python today.py --batch accounts.txt [output directory]
+        sys.exit(1 if batch_main(read_accounts(sys.argv[2]), *sys.argv[3:4]) else 0)
+    if not USER_NAME or HEADERS['authorization'] == 'token ':
+        sys.exit('The ACCESS_TOKEN and USER_NAME environment variables need to be set')
+    print('Calculation times:')
+    build_card(['dark_mode.svg', 'light_mode.svg'], datetime.datetime(2002, 7, 5))
 
     # move cursor to override 'Calculation times:' with 'Total function time:' and the total function time, then move cursor back
+    # the total adds up every stage span, so no timed stage can be left out of it
     print('\033[F\033[F\033[F\033[F\033[F\033[F\033[F\033[F',
-        '{:<21}'.format('Total function time:'), '{:>11}'.format('%.4f' % (user_time + age_time + loc_time + commit_time + star_time + repo_time + contrib_time)),
+        '{:<21}'.format('Total function time:'), '{:>11}'.format('%.4f' % sum(span['duration'] for span in SPANS if span['cat'] == 'stage')),
         ' s \033[E\033[E\033[E\033[E\033[E\033[E\033[E\033[E', sep='')
 
-    print('Total GitHub GraphQL API calls:', '{:>3}'.format(sum(QUERY_COUNT.values())))
-    for funct_name, count in QUERY_COUNT.items(): print('{:<28}'.format('   ' + funct_name + ':'), '{:>6}'.format(count))
\ No newline at end of file
+    print('Total GitHub API calls:', '{:>11}'.format(sum(QUERY_COUNT.values())))
+    for funct_name, count in QUERY_COUNT.items(): print('{:<28}'.format('   ' + funct_name + ':'), '{:>6}'.format(count), '{:>12}'.format('%.4f' % (QUERY_TIME[funct_name] * 1000) + ' ms'))
+    if RATE_LIMIT['remaining'] is not None:
+        print('GitHub rate limit remaining:', '{:>6}'.format(RATE_LIMIT['remaining']), '(resets at ' + RATE_LIMIT['reset_at'] + ')')
+    if RATE_LIMIT['deferred']:
+        print(RATE_LIMIT['deferred'], 'stale repositories were deferred to the next run to stay within the rate limit')
\ No newline at end of file